@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 """
 Find Dupes Fast
@@ -38,22 +38,60 @@ __author__ = "Stephan Sokolow (deitarion/SSokolow)"
 __version__ = "0.3.6"
 __license__ = "GNU GPL 2.0 or later"
 
-import fnmatch, os, re, stat, sys
-from functools import wraps
-
-# Note: In my `python -m timeit` tests, the difference between MD5 and SHA1 was
-# negligible, so there is no meaningful reason not to take advantage of the
-# reduced potential for hash collisions that SHA1's greater hash size offers.
+import fnmatch, mmap, os, re, sqlite3, stat, sys, threading, time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, wraps
+
+# Note: Since the digests are only used as in-memory bucket keys, collision
+# resistance matters but cryptographic strength doesn't, so prefer BLAKE3
+# (SIMD-dispatched, several GB/s) when its module is installed, then BLAKE2b
+# (roughly twice SHA1's throughput on CPUs without SHA extensions) with a
+# 128-bit digest.  SHA1 remains as a fallback for exotic hashlib builds and
+# is still a fine choice where OpenSSL dispatches it to SHA-NI hardware.
 import hashlib
 
+try:
+    from blake3 import blake3 as _blake3
+except ImportError:
+    _blake3 = None
+
+if _blake3 is not None:
+    new_hasher = _blake3  #: Factory for the preferred bucketing hash
+elif hasattr(hashlib, 'blake2b'):
+    def new_hasher():
+        """Return a new hash object of the preferred type for bucketing."""
+        return hashlib.blake2b(digest_size=16)
+else:
+    new_hasher = hashlib.sha1  #: Fallback for hashlib builds without BLAKE2
+
 #: Default settings used by :mod:`optparse` and some functions
 DEFAULTS = {
+    'cache': True,  #: Remember digests of unchanged files between runs.
     'delete': False,
     'exclude': ['*/.svn', '*/.bzr', '*/.git', '*/.hg'],
+    'jobs': 0,  #: Hashing threads. (0 = size the pool to the machine)
     'min_size': 25,  #: Only check files this big or bigger.
 }
-CHUNK_SIZE = 2 ** 16  #: Size for chunked reads from file handles
+CHUNK_SIZE = 2 ** 18  #: Size for chunked reads from file handles
+COMPARE_MEM_BUDGET = 2 ** 23  #: Rough cap on resident chunk memory per
+#: content-comparison group (used to scale the chunk size to group size)
 HEAD_SIZE = 2 ** 14  #: Limit how many bytes will be read to compare headers
+MAX_HANDLES = 100  #: Files :func:`groupByContent` may hold open at once
+try:
+    import resource
+
+    # Respect the process's actual fd limit rather than assuming it can
+    # cover the default budget: up to four content-pass workers may each
+    # hold a full group open at once, and stdio, the hash cache, and pool
+    # internals need headroom too.
+    _nofile = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+    if _nofile != resource.RLIM_INFINITY:
+        MAX_HANDLES = max(10, min(MAX_HANDLES, (_nofile - 64) // 4))
+except ImportError:
+    pass  # Not a POSIX platform; keep the conservative default.
+PREFIX_THRESHOLD = 4  #: Group size at or below which raw header bytes are
+#: compared directly rather than paying to hash them
 
 # {{{ General Helper Functions
 
@@ -63,6 +101,14 @@ try:
 except AttributeError:
     _stat = os.stat
 
+#: ``path -> stat_result`` pairs gathered for free during the
+#: :func:`getPaths` walk so later passes needn't repeat the syscall
+_stat_cache = {}
+
+#: Per-thread reusable read buffers for :func:`_hashFileDigest`
+#: (per-thread because hashing fans out across the thread pool)
+_buffers = threading.local()
+
 def multiglob_compile(globs, prefix=False):
     """Generate a single "A or B or C" regex from a list of shell globs.
 
@@ -74,7 +120,16 @@ def multiglob_compile(globs, prefix=False):
     :type prefix: :class:`~__builtins__.bool`
 
     :rtype: :class:`re.RegexObject`
+
+    Results are memoized, so callers needn't hold on to the compiled
+    pattern to avoid paying for :func:`fnmatch.translate` twice on the
+    same globs.
     """
+    return _multiglob_compile(tuple(globs), prefix)
+
+@lru_cache(maxsize=None)
+def _multiglob_compile(globs, prefix):
+    """Memoized implementation of :func:`multiglob_compile`."""
     if not globs:
         # An empty globs list should only match empty strings
         return re.compile('^$')
@@ -82,6 +137,106 @@ def multiglob_compile(globs, prefix=False):
         globs = [x + '*' for x in globs]
     return re.compile('|'.join(fnmatch.translate(x) for x in globs))
 
+def _threadBuffer(size):
+    """Return this thread's reusable read buffer as a ``size``-byte view.
+
+    :type size: :class:`~__builtins__.int`
+    :rtype: :class:`~__builtins__.memoryview`
+    """
+    buf = getattr(_buffers, 'buf', None)
+    if buf is None or len(buf) < size:
+        buf = _buffers.buf = bytearray(size)
+    return memoryview(buf)[:size]
+
+def _mmapDigest(handle):
+    """Digest a whole file through a read-only ``mmap`` if it's worth it.
+
+    One ``update()`` over a mapping hashes straight out of the page cache
+    with no per-chunk copy into a userspace buffer, and :mod:`hashlib`
+    releases the GIL for the whole pass.  Files under 1MiB keep the
+    streaming path, where mapping setup costs more than the copies it
+    saves.
+
+    :param handle: An open binary file object positioned anywhere.
+    :returns: A hash object covering the file, or ``None`` if the file
+        is too small or unmappable.
+    """
+    try:
+        if os.fstat(handle.fileno()).st_size < 2 ** 20:
+            return None
+        mapped = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+    except (ValueError, OSError):
+        return None
+
+    with mapped:
+        if hasattr(mapped, 'madvise') and hasattr(mmap, 'MADV_SEQUENTIAL'):
+            mapped.madvise(mmap.MADV_SEQUENTIAL)
+        fhash = new_hasher()
+        fhash.update(mapped)
+    return fhash
+
+def _hashFileDigest(handle, limit=None, chunk_size=CHUNK_SIZE):
+    """Raw-digest core of :func:`hashFile`.
+
+    Kept separate so per-file callers like :func:`hashClassifier` get the
+    20-byte dict key directly without a hex-encoding branch or string
+    allocation in the per-file path.
+
+    :rtype: :class:`~__builtins__.bytes`
+    """
+    opened_here = isinstance(handle, str)
+    if opened_here:
+        # A 1MiB userspace buffer makes the buffered layer issue fewer,
+        # bigger read() syscalls for whole-file digests. (Limited reads
+        # keep the default so buffer readahead can't overshoot the limit.)
+        handle = open(handle, 'rb', buffering=-1 if limit else 1 << 20)
+        if hasattr(os, 'posix_fadvise'):
+            # Ask the kernel for aggressive readahead; we always read
+            # internally-opened files front-to-back exactly once.
+            os.posix_fadvise(handle.fileno(), 0, 0,
+                             os.POSIX_FADV_SEQUENTIAL)
+
+    # (Only for paths we opened: a mapping covers the whole file, which
+    # would ignore the position of a caller-seeked handle.)
+    fhash = _mmapDigest(handle) if opened_here and not limit else None
+    if fhash is not None:
+        pass  # Hashed zero-copy from the page cache.
+    elif not limit and hasattr(hashlib, 'file_digest'):
+        # Python 3.11+'s C implementation of the whole-file digest loop:
+        # reads into an internal reusable buffer with the GIL released.
+        fhash = hashlib.file_digest(handle, new_hasher)
+    else:
+        # Chunked digest generation (conserve memory) using one buffer
+        # reused across both chunks and files, so neither allocates and
+        # discards its own bytes objects.
+        fhash, read = new_hasher(), 0
+        view = _threadBuffer(chunk_size)
+        while True:
+            if limit:
+                remaining = limit - read
+                if remaining <= 0:
+                    break
+                # Never read past the limit (a full-sized final read could
+                # pull in and hash up to chunk_size - 1 unrequested bytes)
+                num_read = handle.readinto(
+                    view[:remaining] if remaining < chunk_size else view)
+            else:
+                num_read = handle.readinto(view)
+            if not num_read:
+                break
+            fhash.update(view[:num_read])
+            read += num_read
+
+    if opened_here:
+        if not limit and hasattr(os, 'posix_fadvise'):
+            # A full-file pass never touches these pages again, so evict
+            # them rather than letting a TB-sized scan flush the page cache.
+            # (Limited reads are left cached for the full pass to re-use.)
+            os.posix_fadvise(handle.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+        handle.close()
+
+    return fhash.digest()
+
 def hashFile(handle, want_hex=False, limit=None, chunk_size=CHUNK_SIZE):
     """Generate a hash from a potentially long file.
     Digesting will obey :const:`CHUNK_SIZE` to conserve memory.
@@ -90,42 +245,118 @@ def hashFile(handle, want_hex=False, limit=None, chunk_size=CHUNK_SIZE):
     :param want_hex: If ``True``, returned hash will be hex-encoded.
     :type want_hex: :class:`~__builtins__.bool`
 
-    :param limit: Maximum number of bytes to read (rounded up to a multiple of
-        ``CHUNK_SIZE``)
+    :param limit: Maximum number of bytes to read.
     :type limit: :class:`~__builtins__.int`
 
-    :param chunk_size: Size of :meth:`~__builtins__.file.read` operations
+    :param chunk_size: Size of :meth:`~io.RawIOBase.readinto` operations
         in bytes.
     :type chunk_size: :class:`~__builtins__.int`
 
 
     :rtype: :class:`~__builtins__.str`
-    :returns: A binary or hex-encoded SHA1 hash.
+    :returns: A binary or hex-encoded digest from :func:`new_hasher`.
 
     .. note:: It is your responsibility to close any file-like objects you pass
         in
     """
-    fhash, read = hashlib.sha1(), 0
-    if isinstance(handle, basestring):
-        handle = file(handle, 'rb')
+    digest = _hashFileDigest(handle, limit, chunk_size)
+    return digest.hex() if want_hex else digest
+
+class HashCache(object):
+    """Persistent ``(dev, ino, size, mtime) -> digest`` store.
+
+    Re-running the tool over the same tree is the common interactive use
+    case, so remembering header- and full-content digests between runs
+    turns the second and subsequent scans of unchanged files into pure
+    metadata lookups.
+
+    Digests are keyed on device and inode numbers and only honoured while
+    the file's size and mtime still match; they are also segregated by
+    hash algorithm so a :func:`new_hasher` fallback can't mix digest types
+    within one bucket key space.
+    """
+    def __init__(self, db_path=None):
+        if db_path is None:
+            cache_dir = os.environ.get('XDG_CACHE_HOME') or \
+                os.path.expanduser('~/.cache')
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            db_path = os.path.join(cache_dir, 'fastdupes.sqlite')
+
+        self.algo = new_hasher().name
+        self.conn = sqlite3.connect(db_path)
+
+        # This is a throwaway cache: losing it to a crash merely costs a
+        # re-hash, so trade durability for cheap writes.
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=OFF")
+
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS hashes (
+            algo TEXT, dev INTEGER, ino INTEGER,
+            size INTEGER, mtime_ns INTEGER, head BLOB, full BLOB,
+            PRIMARY KEY(algo, dev, ino))""")
+
+    def get(self, path, limit):
+        """Look up a still-valid cached digest for ``path``.
+
+        :param limit: As in :func:`hashFile`; only :const:`HEAD_SIZE` and
+            unlimited digests are cached.
+        :returns: The digest, or ``None`` on a miss.
+        """
+        filestat = _stat(path)
+        row = self.conn.execute(
+            "SELECT size, mtime_ns, head, full FROM hashes"
+            " WHERE algo=? AND dev=? AND ino=?",
+            (self.algo, filestat.st_dev, filestat.st_ino)).fetchone()
+        if row and row[0] == filestat.st_size and \
+                row[1] == filestat.st_mtime_ns:
+            return row[2] if limit else row[3]
+        return None
+
+    def put(self, path, limit, digest):
+        """Record a freshly-computed digest for ``path``.
+
+        The caller is responsible for calling :meth:`commit` once per
+        batch of puts.
+        """
+        filestat = _stat(path)
+        key = (self.algo, filestat.st_dev, filestat.st_ino)
+        row = self.conn.execute(
+            "SELECT size, mtime_ns, head, full FROM hashes"
+            " WHERE algo=? AND dev=? AND ino=?", key).fetchone()
+
+        # Keep the other digest column only if it's still valid
+        head, full = (row[2], row[3]) if row and \
+            row[0] == filestat.st_size and \
+            row[1] == filestat.st_mtime_ns else (None, None)
+        if limit:
+            head = digest
+        else:
+            full = digest
 
-    if limit:
-        chunk_size = min(chunk_size, limit)
+        self.conn.execute(
+            "INSERT OR REPLACE INTO hashes VALUES (?,?,?,?,?,?,?)",
+            key + (filestat.st_size, filestat.st_mtime_ns, head, full))
 
-    # Chunked digest generation (conserve memory)
-    for block in iter(lambda: handle.read(chunk_size), ''):
-        fhash.update(block)
-        read += chunk_size
-        if 0 < limit <= read:
-            break
+    def commit(self):
+        """Flush pending :meth:`put` calls to disk in one transaction."""
+        self.conn.commit()
 
-    return want_hex and fhash.hexdigest() or fhash.digest()
+
+#: The :class:`HashCache` to consult in :func:`hashClassifier`
+#: (``None`` disables caching)
+hash_cache = None
 
 class OverWriter(object):  # pylint: disable=too-few-public-methods
     """Output helper for handling overdrawing the previous line cleanly."""
+
+    #: Minimum time between progress (non-``newline``) updates in seconds
+    interval = 0.1
+
     def __init__(self, fobj):
         self.max_len = 0
         self.fobj = fobj
+        self.last_update = 0.0
 
         self.isatty = False
         if hasattr(self.fobj, 'fileno'):
@@ -137,11 +368,21 @@ class OverWriter(object):  # pylint: disable=too-few-public-methods
         This function transparently handles tracking how much overdrawing is
         necessary to erase the previous line when used consistently.
 
+        Progress updates (calls without ``newline``) are throttled to at
+        most one per :attr:`interval` so callers can report every step of
+        a hot loop without the terminal writes dominating its runtime.
+
         :param text: The text to be outputted
         :param newline: Whether to start a new line and reset the length count.
         :type text: :class:`~__builtins__.str`
         :type newline: :class:`~__builtins__.bool`
         """
+        if not newline:
+            now = time.monotonic()
+            if now - self.last_update < self.interval:
+                return
+            self.last_update = now
+
         if not self.isatty:
             self.fobj.write('%s\n' % text)
             return
@@ -154,6 +395,7 @@ class OverWriter(object):  # pylint: disable=too-few-public-methods
             self.fobj.write('\n')
             self.max_len = 0
 
+
 out = OverWriter(sys.stderr)
 
 # }}}
@@ -173,14 +415,27 @@ def getPaths(roots, ignores=None):
     :returns: Absolute paths to only files.
     :rtype: :class:`~__builtins__.list` of :class:`~__builtins__.str`
 
-    .. todo:: Try to optimize the ignores matching. Running a regex on every
-       filename is a fairly significant percentage of the time taken according
-       to the profiler.
+    Stat results observed while walking are recorded in
+    :data:`_stat_cache` so passes like :func:`sizeClassifier` don't have
+    to stat every file a second time.
     """
     paths, count, ignores = [], 0, ignores or []
 
-    # Prepare the ignores list for most efficient use
-    ignore_re = multiglob_compile(ignores, prefix=False)
+    # Prepare the ignores list for most efficient use by splitting it into
+    # literal, "literal tail", and glob buckets so the common case of plain
+    # path/directory names is decided by C-level string comparisons and only
+    # true globs fall through to the compiled union regex.
+    literals, tails, globs = set(), [], []
+    for pat in ignores:
+        if not any(char in pat for char in '*?['):
+            literals.add(pat)
+        elif pat.startswith('*') and not any(
+                char in pat[1:] for char in '*?['):
+            tails.append(pat[1:])
+        else:
+            globs.append(pat)
+    literals, tails = frozenset(literals), tuple(tails)
+    ignore_re = multiglob_compile(globs, prefix=False) if globs else None
 
     for root in roots:
         # For safety, only use absolute, real paths.
@@ -192,23 +447,40 @@ def getPaths(roots, ignores=None):
             paths.append(root)
             continue
 
-        for fldr in os.walk(root):
+        # Walk with os.scandir rather than os.walk so each entry's type and
+        # lstat result come along (nearly) for free rather than costing a
+        # second syscall per file in later passes. (DirEntry.path also saves
+        # a Python-level os.path.join per entry.)
+        paths_append, stat_cache = paths.append, _stat_cache
+        folders = [root]
+        while folders:
             out.write("Gathering file paths to compare... (%d files examined)"
                       % count)
 
-            # Don't even descend into IGNOREd directories.
-            for subdir in fldr[1]:
-                dirpath = os.path.join(fldr[0], subdir)
-                if ignore_re.match(dirpath):
-                    fldr[1].remove(subdir)
-
-            for filename in fldr[2]:
-                filepath = os.path.join(fldr[0], filename)
-                if ignore_re.match(filepath):
-                    continue  # Skip IGNOREd files.
-
-                paths.append(filepath)
-                count += 1
+            try:
+                entries = os.scandir(folders.pop())
+            except OSError:
+                continue  # Silently skip unreadable directories.
+
+            with entries:
+                for entry in entries:
+                    entry_path = entry.path
+                    if entry_path in literals or \
+                            entry_path.endswith(tails) or \
+                            (ignore_re and ignore_re.match(entry_path)):
+                        continue  # Skip (and don't descend into) IGNOREs.
+
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            folders.append(entry_path)
+                            continue
+                        stat_cache[entry_path] = entry.stat(
+                            follow_symlinks=False)
+                    except OSError:
+                        continue  # Vanished mid-walk or unstattable.
+
+                    paths_append(entry_path)
+                    count += 1
 
     out.write("Found %s files to be compared for duplication." % (len(paths)),
               newline=True)
@@ -243,7 +515,7 @@ def groupBy(groups_in, classifier, fun_desc='?', keep_uniques=False,
 
     .. todo:: Find some way to bring back the file-by-file status text
     """
-    groups, count, group_count = {}, 0, len(groups_in)
+    groups, count, group_count = defaultdict(set), 0, len(groups_in)
     for pos, paths in enumerate(groups_in.values()):
         out.write("Subdividing group %d of %d by %s... (%d files examined, %d "
                   "in current group)" % (
@@ -251,12 +523,15 @@ def groupBy(groups_in, classifier, fun_desc='?', keep_uniques=False,
                   ))
 
         for key, group in classifier(paths, *args, **kwargs).items():
-            groups.setdefault(key, set()).update(group)
+            groups[key].update(group)
             count += len(group)
 
     if not keep_uniques:
-        # Return only the groups with more than one file.
-        groups = dict([(x, groups[x]) for x in groups if len(groups[x]) > 1])
+        # Keep only the groups with more than one file.
+        # (Deleting in place rather than rebuilding the dict, which would
+        # allocate a new table proportional to the number of groups)
+        for key in [x for x in groups if len(groups[x]) < 2]:
+            del groups[key]
 
     out.write("Found %s sets of files with identical %s. (%d files examined)"
               % (len(groups), fun_desc, count), newline=True)
@@ -278,53 +553,402 @@ def groupify(function):
 
     @wraps(function)
     def wrapper(paths, *args, **kwargs):  # pylint: disable=missing-docstring
-        groups = {}
+        groups = defaultdict(set)
 
         for path in paths:
             key = function(path, *args, **kwargs)
             if key is not None:
-                groups.setdefault(key, set()).add(path)
+                groups[key].add(path)
 
         return groups
     return wrapper
 
-@groupify
-def sizeClassifier(path, min_size=DEFAULTS['min_size']):
-    """Sort a file into a group based on on-disk size.
+def sizeClassifier(paths, min_size=DEFAULTS['min_size']):
+    """Sort a group of files into subgroups based on on-disk size.
+
+    Operates on the whole group at once (rather than per-path via
+    :func:`groupify`) so the million-file initial bucketing pays for one
+    function call and locally-bound lookups rather than a Python call
+    per file.
 
-    :param paths: See :func:`fastdupes.groupify`
+    :param paths: Paths of files to bucket by size.
+    :type paths: iterable of :class:`~__builtins__.str`
 
     :param min_size: Files smaller than this size (in bytes) will be ignored.
     :type min_size: :class:`__builtins__.int`
 
-    :returns: See :func:`fastdupes.groupify`
+    :returns: A dict mapping sizes to groups of paths.
+    :rtype: :class:`~__builtins__.dict`
+    """
+    groups = defaultdict(set)
+    cached_stat, is_link = _stat_cache.get, stat.S_ISLNK
+    for path in paths:
+        filestat = cached_stat(path) or _stat(path)
+        if is_link(filestat.st_mode):
+            continue  # Skip symlinks.
+
+        if filestat.st_size < min_size:
+            continue  # Skip files below the size limit
+
+        groups[filestat.st_size].add(path)
+    return groups
+
+def _inodeOrder(paths):
+    """Return ``paths`` as a list sorted by ``(st_dev, st_ino)``.
+
+    Walk order is essentially random with respect to physical layout, so
+    reading a group in that order makes a spinning disk seek all over the
+    platter.  Inode numbers are a decent proxy for on-disk position on
+    most Unix filesystems, and grouping by device first keeps the ordering
+    meaningful when a group straddles filesystems.
+
+    :param paths: Paths to be reordered for reading.
+    :type paths: iterable of :class:`~__builtins__.str`
+
+    :rtype: :class:`~__builtins__.list` of :class:`~__builtins__.str`
+    """
+    def sort_key(path):  # pylint: disable=missing-docstring
+        filestat = _stat_cache.get(path) or _stat(path)
+        return filestat.st_dev, filestat.st_ino
+    return sorted(paths, key=sort_key)
+
+def _readHead(path, limit):
+    """Read the first ``limit`` bytes of a file using raw syscalls.
+
+    The header prefilter issues one small read on each of potentially
+    millions of files, so per-file overhead dominates.  Going through
+    ``open()`` pays for a :class:`io.BufferedReader` and its readahead
+    machinery just to fetch a single block; ``open``/``pread``/``close``
+    keeps it to three syscalls and one allocation per file.
+
+    :param path: File to read the head of.
+    :type path: :class:`~__builtins__.str`
+    :param limit: Number of bytes to read.
+    :type limit: :class:`~__builtins__.int`
+
+    :rtype: :class:`~__builtins__.bytes`
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        return os.pread(fd, limit, 0)
+    finally:
+        os.close(fd)
+
 
-    .. todo:: Rework the calling of :func:`~os.stat` to minimize the number of
-        calls. It's a fairly significant percentage of the time taken according
-        to the profiler.
+#: ``path -> (hash object, offset)`` snapshots taken during the header
+#: pass so the full-content pass can resume mid-sized files where the
+#: header hash left off instead of re-reading and re-hashing those bytes
+#: (as the old second-comparison TODO asked for)
+_head_hashers = {}
+
+def _hashHead(path, limit):
+    """Hash just the first ``limit`` bytes of a file via :func:`_readHead`.
+
+    For files the full-content pass will want later (bigger than
+    ``limit`` but below :func:`_mmapDigest`'s threshold, where restarting
+    costs more than it saves), the hasher's state is snapshotted into
+    :data:`_head_hashers` so that pass can pick up at ``limit``.
+
+    :rtype: :class:`~__builtins__.bytes`
+    """
+    fhash = new_hasher()
+    fhash.update(_readHead(path, limit))
+
+    filestat = _stat_cache.get(path) or _stat(path)
+    if limit < filestat.st_size < 2 ** 20:
+        _head_hashers[path] = (fhash.copy(), limit)
+    return fhash.digest()
+
+def _resumeDigest(path, fhash, offset):
+    """Finish a whole-file digest begun by :func:`_hashHead`.
+
+    ``fhash`` already covers the first ``offset`` bytes, so the result
+    is identical to hashing the file from scratch minus re-reading them.
+
+    :rtype: :class:`~__builtins__.bytes`
     """
-    filestat = _stat(path)
-    if stat.S_ISLNK(filestat.st_mode):
-        return  # Skip symlinks.
+    with open(path, 'rb', buffering=1 << 20) as handle:
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(handle.fileno(), 0, 0,
+                             os.POSIX_FADV_SEQUENTIAL)
+        handle.seek(offset)
+        view = _threadBuffer(CHUNK_SIZE)
+        while True:
+            num_read = handle.readinto(view)
+            if not num_read:
+                break
+            fhash.update(view[:num_read])
+    return fhash.digest()
+
+def _fullDigest(path):
+    """Whole-file digest, resuming from header-pass state when held.
+
+    :rtype: :class:`~__builtins__.bytes`
+    """
+    held = _head_hashers.pop(path, None)
+    if held is not None:
+        return _resumeDigest(path, *held)
+    return _hashFileDigest(path)
+
 
-    if filestat.st_size < min_size:
-        return  # Skip files below the size limit
+#: Lazily-created thread pool shared by all :func:`hashClassifier` calls
+#: (classifiers are called once per group, so a per-call pool would be
+#: re-created millions of times on big trees)
+_hash_pool = None
 
-    return filestat.st_size
+#: Worker count for the hashing pool. Zero sizes it to the machine;
+#: set before the first :func:`hashClassifier` call (e.g. via
+#: :option:`--jobs`) to pin it, such as to 1-2 for a spinning disk that
+#: seeks itself silly under concurrent readers.
+pool_size = 0
 
-@groupify
-def hashClassifier(path, limit=HEAD_SIZE):
-    """Sort a file into a group based on its SHA1 hash.
+def hashClassifier(paths, limit=None):
+    """Sort a group of files into subgroups based on their hash digests.
 
-    :param paths: See :func:`fastdupes.groupify`
+    Files are hashed in a shared thread pool so that several ``read()``
+    calls are in flight at once rather than the disk idling while Python
+    hashes and vice-versa. (:mod:`hashlib` releases the GIL inside
+    ``update()``, so the overlap is real.)
+
+    :param paths: Paths of potentially identical files.
+    :type paths: iterable of :class:`~__builtins__.str`
 
     :param limit: Only this many bytes will be counted in the hash.
         Values which evaluate to ``False`` indicate no limit.
     :type limit: :class:`__builtins__.int`
 
-    :returns: See :func:`fastdupes.groupify`
+    :returns: A dict mapping digests to groups of paths.
+    :rtype: :class:`~__builtins__.dict`
+    """
+    global _hash_pool  # pylint: disable=global-statement
+    if _hash_pool is None:
+        _hash_pool = ThreadPoolExecutor(
+            max_workers=pool_size or min(32, (os.cpu_count() or 1) * 4))
+
+    groups, paths = defaultdict(set), _inodeOrder(paths)
+
+    # Satisfy what we can from the persistent cache before hashing
+    cache = hash_cache if (not limit or limit == HEAD_SIZE) else None
+    if cache:
+        misses = []
+        for path in paths:
+            digest = cache.get(path, limit)
+            if digest is None:
+                misses.append(path)
+            else:
+                groups[digest].add(path)
+        paths = misses
+
+    # For tiny groups, the raw header bytes are a perfectly good dict key
+    # and skipping the hash is cheaper than computing it. (Only when no
+    # cached digests joined the key space above, so one file of a pair
+    # can't end up keyed by digest and the other by raw bytes.)
+    if limit and limit <= CHUNK_SIZE and not groups and \
+            len(paths) <= PREFIX_THRESHOLD and hasattr(os, 'pread'):
+        for path in paths:
+            # Namespaced so a raw key can never equal a digest key once
+            # groupBy merges this call's groups with other size-groups'
+            # (a file's head could happen to BE another group's digest).
+            groups[('raw', _readHead(path, limit))].add(path)
+        return groups
+
+    if limit and limit <= CHUNK_SIZE and hasattr(os, 'pread'):
+        def hash_func(path):  # pylint: disable=missing-docstring
+            return _hashHead(path, limit)
+    elif limit:
+        def hash_func(path):  # pylint: disable=missing-docstring
+            return _hashFileDigest(path, limit=limit)
+    else:
+        hash_func = _fullDigest
+    digests = _hash_pool.map(hash_func, paths)
+    for path, digest in zip(paths, digests):
+        if cache:
+            cache.put(path, limit, digest)
+        groups[digest].add(path)
+    if cache:
+        cache.commit()
+    return groups
+
+def _openForCompare(path):
+    """Open a file for chunked comparison, preferring a read-only ``mmap``.
+
+    A mapping serves :func:`compareChunks`'s ``read()`` calls straight out
+    of the page cache with no per-chunk ``read()`` syscall, and
+    ``MADV_SEQUENTIAL`` asks the kernel to read ahead aggressively for the
+    front-to-back access pattern.  Empty files (which can't be mapped) and
+    platforms where mapping fails get an ordinary handle instead; both
+    objects answer the same ``read()``/``close()`` calls.
+
+    :param path: File to be opened.
+    :type path: :class:`~__builtins__.str`
+    """
+    fhandle = open(path, 'rb')
+    try:
+        mapped = mmap.mmap(fhandle.fileno(), 0, access=mmap.ACCESS_READ)
+    except (ValueError, OSError):
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(fhandle.fileno(), 0, 0,
+                             os.POSIX_FADV_SEQUENTIAL)
+        return fhandle
+    fhandle.close()
+
+    if hasattr(mapped, 'madvise'):
+        if hasattr(mmap, 'MADV_SEQUENTIAL'):
+            mapped.madvise(mmap.MADV_SEQUENTIAL)
+        if hasattr(mmap, 'MADV_WILLNEED'):
+            # Kick off prefetch of the leading pages so the first rounds
+            # of comparison don't each begin with a cold page fault.
+            mapped.madvise(mmap.MADV_WILLNEED, 0,
+                           min(len(mapped), COMPARE_MEM_BUDGET))
+    return mapped
+
+def _fingerprintSplit(paths, offset=0):
+    """Subdivide an oversized group by fingerprinting successive chunks.
+
+    Only one file is held open at a time: each candidate is re-opened,
+    seeked to the shared offset, read, hashed, and closed again, so group
+    size places no pressure on the file handle limit.
+
+    :param paths: Paths of potentially identical files.
+    :type paths: iterable
+
+    :param offset: File offset at which the round of comparison starts.
+    :type offset: :class:`~__builtins__.int`
+
+    :returns: ``(group, at_eof)`` pairs where ``at_eof`` groups matched
+        fingerprints over their entire remaining length.
+    :rtype: generator of ``(list, bool)``
+    """
+    pending = [(list(paths), offset)]
+    while pending:
+        group, offset = pending.pop()
+        buckets, at_eof = {}, []
+        for path in group:
+            try:
+                with open(path, 'rb') as fhandle:
+                    fhandle.seek(offset)
+                    chunk = fhandle.read(CHUNK_SIZE)
+            except IOError:
+                continue  # Silently ignore unreadable files.
+
+            if chunk:
+                fhash = new_hasher()
+                fhash.update(chunk)
+                buckets.setdefault(fhash.digest(), []).append(path)
+            else:
+                at_eof.append(path)
+
+        if at_eof:
+            yield at_eof, True
+        for matches in buckets.values():
+            if len(matches) > MAX_HANDLES:
+                pending.append((matches, offset + CHUNK_SIZE))
+            else:
+                yield matches, False
+
+def _compareChunkSize(handle_count):
+    """Pick a comparison read size scaled to the number of open handles.
+
+    Bigger chunks amortize per-round overhead and seek interleaving, but
+    every open handle holds one chunk in memory at a time, so the size is
+    scaled down for large groups to keep each group's resident chunk
+    memory around :const:`COMPARE_MEM_BUDGET`.
+
+    :param handle_count: Number of files being compared in lock-step.
+    :type handle_count: :class:`~__builtins__.int`
+
+    :rtype: :class:`~__builtins__.int`
+    """
+    return max(2 ** 16,
+               min(2 ** 20, COMPARE_MEM_BUDGET // max(1, handle_count)))
+
+def _comparePair(path_a, path_b):
+    """Byte-compare exactly two files with a minimum of machinery.
+
+    Two files sharing a size and header is by far the most common shape
+    of group to reach the content pass, and the general bucketing path
+    pays for dicts, tuples, and group lists it doesn't need there.
+
+    :returns: Finished groups shaped like :func:`compareChunks`'s
+        ``done`` output.
+    :rtype: :class:`~__builtins__.list` of :class:`~__builtins__.list`
+    """
+    opened = []
+    for path in (path_a, path_b):
+        try:
+            opened.append((path, _openForCompare(path)))
+        except IOError:
+            pass  # Silently ignore files we can't read.
+
+    if len(opened) < 2:
+        for path, fhandle in opened:
+            fhandle.close()
+        return [[path] for path, _ in opened]
+
+    # With only two handles in play, the memory budget allows the largest
+    # read size, cutting the round count relative to the generic path.
+    chunk_size = _compareChunkSize(2)
+
+    (path_a, hnd_a), (path_b, hnd_b) = opened
+    try:
+        while True:
+            chunk_a = hnd_a.read(chunk_size)
+            if chunk_a != hnd_b.read(chunk_size):
+                return [[path_a], [path_b]]
+            if not chunk_a:
+                return [[path_a, path_b]]
+    finally:
+        hnd_a.close()
+        hnd_b.close()
+
+def _tailSplit(paths):
+    """Pre-bucket a group by a digest of each file's final chunk.
+
+    Same-size, same-header files frequently diverge near EOF
+    (append-mostly logs, archives with trailing indexes, VM images), so
+    one ``pread`` per file can dissolve a group for the cost of a single
+    chunk each rather than streaming the shared prefix front-to-back.
+    The buckets are only a grouping hint -- every multi-member bucket is
+    still byte-compared from offset zero -- so hashing the tails can't
+    introduce false duplicates.
+
+    :param paths: Paths of potentially identical files.
+    :type paths: iterable
+
+    :returns: Sub-groups of ``paths``. (One group, unchanged, when the
+        files are too small for the extra seek to pay off.)
+    :rtype: :class:`~__builtins__.list` of :class:`~__builtins__.list`
     """
-    return hashFile(path, limit=limit)
+    paths = list(paths)
+    if len(paths) < 2 or not hasattr(os, 'pread'):
+        return [paths]
+
+    sizes = []
+    for path in paths:
+        filestat = _stat_cache.get(path) or _stat(path)
+        sizes.append(filestat.st_size)
+    if min(sizes) <= CHUNK_SIZE * 4:
+        # The streaming compare reaches the tail within its first few
+        # chunks anyway; the extra seek would cost more than it saves.
+        return [paths]
+
+    buckets = defaultdict(list)
+    for path, size in zip(paths, sizes):
+        try:
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                tail = os.pread(fd, CHUNK_SIZE, size - CHUNK_SIZE)
+            finally:
+                os.close(fd)
+        except OSError:
+            # Isolate unreadable files; downstream opens would drop them.
+            buckets[('unreadable', path)].append(path)
+            continue
+
+        fhash = new_hasher()
+        fhash.update(tail)
+        buckets[fhash.digest()].append(path)
+    return list(buckets.values())
 
 def groupByContent(paths):
     """Byte-for-byte comparison on an arbitrary number of files in parallel.
@@ -334,7 +958,11 @@ def groupByContent(paths):
 
         - Reads the same total amount of data as hash comparison.
         - Performs a *lot* of disk seeks. (Best suited for SSDs)
-        - Vulnerable to file handle exhaustion if used on its own.
+
+    Groups too big for :const:`MAX_HANDLES` are first subdivided by
+    :func:`_fingerprintSplit`, which holds no more than one file open at a
+    time, so pathological piles of same-size, same-header files can no
+    longer exhaust the file handle limit.
 
     :param paths: List of potentially identical files.
     :type paths: iterable
@@ -346,33 +974,103 @@ def groupByContent(paths):
         minimize thrashing in situations where read-ahead caching is active.
         Compare savings by read-ahead to savings due to eliminating false
         positives as quickly as possible. This is a 2-variable min/max problem.
-
-    .. todo:: Look into possible solutions for pathological cases of thousands
-        of files with the same size and same pre-filter results. (File handle
-        exhaustion)
     """
-    handles, results = [], []
+    paths, results, todo = _inodeOrder(paths), [], []
+    for bucket in _tailSplit(paths):
+        if len(bucket) == 1:
+            results.append(bucket)
+        elif len(bucket) == 2:
+            results.extend(_comparePair(*bucket))
+        elif len(bucket) > MAX_HANDLES:
+            for group, at_eof in _fingerprintSplit(bucket):
+                if len(group) == 1 or (at_eof and len(group) > MAX_HANDLES):
+                    # Unique, or fingerprint-identical to EOF but too
+                    # numerous to re-verify byte-for-byte within the
+                    # handle budget.
+                    results.append(group)
+                else:
+                    todo.append(group)
+        else:
+            todo.append(bucket)
 
-    # Silently ignore files we don't have permission to read.
-    hList = []
-    for path in paths:
-        try:
-            hList.append((path, open(path, 'rb'), ''))
-        except IOError:
-            pass  # TODO: Verbose-mode output here.
-    handles.append(hList)
+    for group in todo:
+        handles = []
 
-    while handles:
-        # Process more blocks.
-        more, done = compareChunks(handles.pop(0))
+        # Silently ignore files we don't have permission to read.
+        hList = []
+        for path in group:
+            try:
+                hList.append((path, _openForCompare(path), b''))
+            except IOError:
+                pass  # TODO: Verbose-mode output here.
+        handles.append(hList)
+        chunk_size = _compareChunkSize(len(hList))
 
-        # Add the results to the top-level lists.
-        handles.extend(more)
-        results.extend(done)
+        try:
+            while handles:
+                # Process more blocks.
+                more, done = compareChunks(handles.pop(0), chunk_size)
+
+                # Add the results to the top-level lists.
+                handles.extend(more)
+                results.extend(done)
+        finally:
+            # compareChunks closes handles as their groups finish, so this
+            # only matters if an exception cut the loop short; without it,
+            # still-queued handles would wait on the GC (or leak on
+            # runtimes without refcounting).
+            for group in handles:
+                for entry in group:
+                    try:
+                        entry[1].close()
+                    except OSError:
+                        pass
 
     # Keep the same API as the others.
     return dict((x[0], x) for x in results)
 
+
+#: Lazily-created pool for running :func:`groupByContent` groups
+#: concurrently.  Deliberately small: each group may hold up to
+#: :const:`MAX_HANDLES` files open, so worker count times handle budget
+#: has to stay comfortably inside typical fd rlimits.
+_content_pool = None
+
+def _groupByContentParallel(groups_in):
+    """Run :func:`groupByContent` over independent groups concurrently.
+
+    Each surviving size/header group touches disjoint files, so the
+    groups can be compared in parallel.  Threads rather than processes:
+    the work is I/O-bound, chunk comparison happens in C with the GIL
+    released during reads, and open handles wouldn't survive pickling
+    anyway.
+
+    :param groups_in: Grouped sets of paths, as for :func:`groupBy`.
+    :type groups_in: :class:`~__builtins__.dict` of iterables
+
+    :returns: A dict mapping one path per duplicate set to the set's
+        members, as :func:`groupBy` would return.
+    :rtype: :class:`~__builtins__.dict`
+    """
+    global _content_pool  # pylint: disable=global-statement
+    if _content_pool is None:
+        _content_pool = ThreadPoolExecutor(
+            max_workers=min(4, os.cpu_count() or 1))
+
+    groups, count = defaultdict(set), 0
+    for result in _content_pool.map(groupByContent,
+                                    list(groups_in.values())):
+        for key, group in result.items():
+            groups[key].update(group)
+            count += len(group)
+
+    for key in [x for x in groups if len(groups[x]) < 2]:
+        del groups[key]
+
+    out.write("Found %s sets of files with identical contents. (%d files "
+              "examined)" % (len(groups), count), newline=True)
+    return groups
+
 def compareChunks(handles, chunk_size=CHUNK_SIZE):
     """Group a list of file handles based on equality of the next chunk of
     data read from them.
@@ -393,26 +1091,25 @@ def compareChunks(handles, chunk_size=CHUNK_SIZE):
     .. attention:: File handles will be closed when no longer needed
     .. todo:: Discard chunk contents immediately once they're no longer needed
     """
-    chunks = [(path, fh, fh.read(chunk_size)) for path, fh, _ in handles]
     more, done = [], []
 
-    # While there are combinations not yet tried...
-    while chunks:
-        # Compare the first chunk to all successive chunks
-        matches, non_matches = [chunks[0]], []
-        for chunk in chunks[1:]:
-            if matches[0][2] == chunk[2]:
-                matches.append(chunk)
-            else:
-                non_matches.append(chunk)
+    # Bucket the handles by chunk contents in a single pass. (Using the
+    # chunk bytes themselves as dict keys touches each chunk's memory once
+    # rather than memcmp-ing every pair of chunks per round)
+    buckets = {}
+    bucket_for = buckets.setdefault
+    for path, fh, _ in handles:
+        chunk = fh.read(chunk_size)
+        bucket_for(chunk, []).append((path, fh, chunk))
+
+    for chunk, matches in buckets.items():
         # Check for EOF or obviously unique files
-        if len(matches) == 1 or matches[0][2] == "":
+        if len(matches) == 1 or chunk == b"":
             for x in matches:
                 x[1].close()
             done.append([x[0] for x in matches])
         else:
             more.append(matches)
-        chunks = non_matches
 
     return more, done
 
@@ -439,14 +1136,14 @@ def pruneUI(dupeList, mainPos=1, mainLen=1):
     :rtype: :class:`~__builtins__.int`
     """
     dupeList = sorted(dupeList)
-    print
+    print()
     for pos, val in enumerate(dupeList):
-        print "%d) %s" % (pos + 1, val)
+        print("%d) %s" % (pos + 1, val))
     while True:
-        choice = raw_input("[%s/%s] Keepers: " % (mainPos, mainLen)).strip()
+        choice = input("[%s/%s] Keepers: " % (mainPos, mainLen)).strip()
         if not choice:
-            print ("Please enter a space/comma-separated list of numbers or "
-                   "'all'.")
+            print("Please enter a space/comma-separated list of numbers or "
+                  "'all'.")
             continue
         elif choice.lower() == 'all':
             return []
@@ -476,26 +1173,80 @@ def find_dupes(paths, exact=False, ignores=None, min_size=0):
     groups = {'': getPaths(paths, ignores)}
     groups = groupBy(groups, sizeClassifier, 'sizes', min_size=min_size)
 
+    # Hardlinks to one inode are byte-identical by definition, so hash and
+    # compare a single representative per (st_dev, st_ino) and re-attach
+    # the other names to whatever verdict it earns.  (Package managers and
+    # backup tools can produce dozens of links to the same blocks.)
+    hardlinks = {}
+    for key, group in groups.items():
+        by_inode = {}
+        for path in sorted(group):
+            filestat = _stat_cache.get(path) or _stat(path)
+            by_inode.setdefault(
+                (filestat.st_dev, filestat.st_ino), []).append(path)
+        if len(by_inode) < len(group):
+            reps = set()
+            for aliases in by_inode.values():
+                reps.add(aliases[0])
+                if len(aliases) > 1:
+                    hardlinks[aliases[0]] = aliases[1:]
+            groups[key] = reps
+
     # This serves one of two purposes depending on run-mode:
     # - Minimize number of files checked by full-content comparison (hash)
     # - Minimize chances of file handle exhaustion and limit seeking (exact)
     groups = groupBy(groups, hashClassifier, 'header hashes', limit=HEAD_SIZE)
 
     if exact:
-        groups = groupBy(groups, groupByContent, fun_desc='contents')
+        groups = _groupByContentParallel(groups)
     else:
-        groups = groupBy(groups, hashClassifier, fun_desc='hashes')
+        # For files no larger than HEAD_SIZE the header hash already
+        # covered every byte, so re-reading and re-hashing them in the
+        # full-content pass would prove nothing new.  Only larger files
+        # get the second pass; the small groups are passed through.
+        small, large = {}, {}
+        for key, group in groups.items():
+            path = next(iter(group))
+            filestat = _stat_cache.get(path) or _stat(path)
+            if filestat.st_size <= HEAD_SIZE:
+                small[key] = group
+            else:
+                large[key] = group
+
+        groups = groupBy(large, hashClassifier, fun_desc='hashes')
+        for key, group in small.items():
+            # Re-key under a tuple so a raw header-bytes key can never
+            # collide with a digest from the full-content pass.
+            groups[('head', key)] = group
+
+    # Snapshots for files whose header groups dissolved (or that the
+    # exact-mode content pass verified directly) have no further use.
+    _head_hashers.clear()
+
+    if hardlinks:
+        # Put the hardlinked names back beside their representatives...
+        expanded = set()
+        for group in groups.values():
+            for path in list(group):
+                if path in hardlinks:
+                    group.update(hardlinks[path])
+                    expanded.add(path)
+        # ...and a hardlink set whose representative proved unique is
+        # still a set of identical files in its own right.
+        for rep, aliases in hardlinks.items():
+            if rep not in expanded:
+                groups[('hardlinks', rep)] = set([rep] + aliases)
 
     return groups
 
 def print_defaults():
     """Pretty-print the contents of :data:`DEFAULTS`"""
-    maxlen = max([len(x) for x in DEFAULTS])
+    maxlen = max(len(x) for x in DEFAULTS)
     for key in DEFAULTS:
         value = DEFAULTS[key]
         if isinstance(value, (list, set)):
             value = ', '.join(value)
-        print "%*s: %s" % (maxlen, key, value)
+        print("%*s: %s" % (maxlen, key, value))
 
 def delete_dupes(groups, prefer_list=None, interactive=True, dry_run=False):
     """Code to handle the :option:`--delete` command-line option.
@@ -530,7 +1281,7 @@ def delete_dupes(groups, prefer_list=None, interactive=True, dry_run=False):
 
         assert preferred  # Safety check
         for path in pruneList:
-            print "Removing %s" % path
+            print("Removing %s" % path)
             if not dry_run:
                 os.remove(path)
 
@@ -558,6 +1309,13 @@ def main():
         " added to the internal blacklist. This option can be used multiple"
         " times. Provide a dash (-) as your first exclude to override the"
         " pre-programmed defaults.")
+    filter_group.add_option('--no-cache', action="store_false", dest="cache",
+        help="Don't reuse (or record) file hashes from previous runs via the"
+        " on-disk hash cache.")
+    filter_group.add_option('-j', '--jobs', action="store", type="int",
+        dest="jobs", metavar="N", help="Hash files using up to N threads"
+        " rather than sizing the pool to the machine. Try 1 or 2 if a"
+        " spinning disk spends more time seeking than reading.")
     filter_group.add_option('--min-size', action="store", type="int",
         dest="min_size", metavar="X", help="Specify a non-default minimum size"
         ". Files below this size (default: %default bytes) will be ignored.")
@@ -592,6 +1350,17 @@ def main():
         print_defaults()
         sys.exit()
 
+    if opts.jobs:
+        global pool_size  # pylint: disable=global-statement
+        pool_size = max(1, opts.jobs)
+
+    if opts.cache:
+        global hash_cache  # pylint: disable=global-statement
+        try:
+            hash_cache = HashCache()
+        except (OSError, sqlite3.Error):
+            pass  # The cache is only an optimization. Scan without it.
+
     groups = find_dupes(args, opts.exact, opts.exclude, opts.min_size)
 
     if opts.delete:
@@ -599,7 +1368,8 @@ def main():
                      opts.dry_run)
     else:
         for dupeSet in groups.values():
-            print '\n'.join(dupeSet) + '\n'
+            print('\n'.join(dupeSet) + '\n')
+
 
 if __name__ == '__main__':
     main()